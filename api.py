@@ -3,17 +3,30 @@
 # for yt-dlp authentication.
 # Save this file as 'api.py' in your project's root directory.
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, HTTPException, status
-from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
+from cachetools import TTLCache
+import anyio
 import yt_dlp
 import uvicorn
+import atexit
+import hashlib
 import os
-import shutil
+import queue
 import asyncio
 import tempfile # For creating temporary cookie files
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Runs one-time startup work per worker process."""
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    yield
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Video Downloader API (Ethical Use Only)",
     description="""
     This API provides endpoints for downloading and converting videos to MP3 using yt-dlp.
@@ -24,13 +37,50 @@ app = FastAPI(
 )
 
 # Directory to save downloaded files.
-DOWNLOAD_DIR = "downloads"
-# Ensure the downloads directory exists.
-# The Dockerfile also ensures this, but it's good practice here too.
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+# Resolved to an absolute path once at import so per-request path joins
+# don't re-resolve the working directory.
+DOWNLOAD_DIR = os.path.abspath("downloads")
+
+# Cookie file for yt-dlp authentication, written once at import since the
+# environment doesn't change over the process lifetime. Permissions are
+# restricted to the owner because cookies are credentials.
+_COOKIE_FILE = None
+if (_cookie_string := os.getenv('YTDLP_COOKIES')):
+    _fd, _COOKIE_FILE = tempfile.mkstemp(prefix="ytdlp_cookies_", suffix=".txt")
+    os.write(_fd, _cookie_string.encode('utf-8'))
+    os.close(_fd)
+    os.chmod(_COOKIE_FILE, 0o600)
+    atexit.register(lambda path=_COOKIE_FILE: os.path.exists(path) and os.unlink(path))
+
+# Mount a static directory to serve the downloaded files.
+# check_dir is disabled because the directory is created by the lifespan
+# handler at startup, after the mount is registered.
+app.mount("/downloads", StaticFiles(directory=DOWNLOAD_DIR, check_dir=False), name="downloads")
+
+# Cache of completed downloads keyed by (endpoint, url), so repeat requests
+# for the same URL skip the whole yt-dlp/FFmpeg pipeline. Entries are
+# revalidated against the filesystem before use in case files were cleaned up.
+_DOWNLOAD_CACHE = TTLCache(maxsize=1024, ttl=3600)
+_DOWNLOAD_CACHE_LOCK = asyncio.Lock()
+
+def _cache_key(endpoint, url):
+    """Builds a stable cache key for a download request."""
+    return hashlib.sha1(f"{endpoint}:{url}".encode()).hexdigest()
+
+async def get_cached_filepath(key):
+    """Returns the cached filepath for a key if it still exists on disk."""
+    async with _DOWNLOAD_CACHE_LOCK:
+        filepath = _DOWNLOAD_CACHE.get(key)
+    # The existence check is a stat syscall; do it off the event-loop thread
+    # so slow storage (e.g. network-mounted volumes) can't stall other requests.
+    if filepath and await anyio.Path(filepath).exists():
+        return filepath
+    return None
 
-# Mount a static directory to serve the downloaded files
-app.mount("/downloads", StaticFiles(directory=DOWNLOAD_DIR), name="downloads")
+async def cache_filepath(key, filepath):
+    """Records the final filepath for a completed download."""
+    async with _DOWNLOAD_CACHE_LOCK:
+        _DOWNLOAD_CACHE[key] = filepath
 
 # Function to get yt-dlp options, including cookie handling
 def get_ydl_opts(output_template, cookie_file_path=None):
@@ -41,62 +91,95 @@ def get_ydl_opts(output_template, cookie_file_path=None):
         'quiet': True,
         'no_warnings': True,
         'noplaylist': True,
-        'extract_flat': True, # Use for faster metadata extraction without full downloads
     }
     if cookie_file_path:
         opts['cookiefile'] = cookie_file_path
     return opts
 
+# The options are identical for every request, so YoutubeDL instances can be
+# pooled and reused; __init__ (extractor registry, format selector compilation,
+# postprocessor setup) is non-trivial per-request overhead. Instances aren't
+# thread-safe, so each worker thread checks one out around extract_info.
+OUTPUT_TEMPLATE = os.path.join(DOWNLOAD_DIR, '%(title)s-%(id)s.%(ext)s')
+_YDL_POOL = queue.SimpleQueue()
+
+# Bound how many yt-dlp pipelines run at once. Without this, a burst of
+# requests silently queues in the loop's shared default thread pool while the
+# server keeps accepting work, each pending job holding sockets and memory.
+# A dedicated executor keeps the pool size explicit and separate from other
+# stdlib thread-pool users.
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))
+DOWNLOAD_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+_DOWNLOAD_EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix="yt-dlp"
+)
+
+def _acquire_ydl():
+    """Takes a pooled YoutubeDL instance, creating one if the pool is empty."""
+    try:
+        return _YDL_POOL.get_nowait()
+    except queue.Empty:
+        return yt_dlp.YoutubeDL(get_ydl_opts(OUTPUT_TEMPLATE, _COOKIE_FILE))
+
+def _release_ydl(ydl):
+    """Returns a YoutubeDL instance to the pool for reuse."""
+    _YDL_POOL.put(ydl)
+
 # Function to run blocking yt-dlp operations in a separate thread
-async def run_yt_dlp_operation(url, output_template, cookie_string=None):
+async def run_yt_dlp_operation(url):
     """
-    Handles yt-dlp download/extraction in a separate thread,
-    optionally using cookies from an environment variable.
+    Handles yt-dlp download/extraction in a separate thread, using the
+    cookie file written at startup when cookies are configured.
     """
-    # Use a context manager for temporary file to ensure it's cleaned up
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, encoding='utf-8') as tmp_cookie_file:
-        if cookie_string:
-            tmp_cookie_file.write(cookie_string)
-        cookie_file_path = tmp_cookie_file.name
-
-    try:
-        # Define the blocking function that yt-dlp will run
-        def blocking_download():
-            ydl_opts = get_ydl_opts(output_template, cookie_file_path)
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                # yt-dlp's info dictionary contains the final filepath after post-processing
-                # For simple video/audio downloads, 'filepath' is usually directly in info.
-                # For post-processed files (like mp3 extraction), it might require inference.
-
-                final_filepath = info.get('filepath')
-                if not final_filepath:
-                    # Robust way to find the actual downloaded file if 'filepath' is not direct
-                    title = info.get('title', 'unknown_title')
-                    video_id = info.get('id', 'unknown_id')
-                    # yt-dlp adds the correct extension during post-processing
-                    potential_filename_prefix = f"{title}-{video_id}"
-
-                    # Search for the actual file in the download directory
-                    found_files = [
-                        f for f in os.listdir(DOWNLOAD_DIR)
-                        if f.startswith(potential_filename_prefix)
-                    ]
-
-                    if found_files:
-                        final_filepath = os.path.join(DOWNLOAD_DIR, found_files[0])
-                    else:
-                        raise Exception("Could not reliably determine the final downloaded file path.")
-                
-                return final_filepath
-
-        # Use asyncio.to_thread to run the blocking yt-dlp operation
-        filepath = await asyncio.to_thread(blocking_download)
-        return filepath
-    finally:
-        # Ensure the temporary cookie file is deleted
-        if os.path.exists(cookie_file_path):
-            os.remove(cookie_file_path)
+    # Define the blocking function that yt-dlp will run
+    def blocking_download():
+        ydl = _acquire_ydl()
+        try:
+            info = ydl.extract_info(url, download=True)
+            # With a full (non-flat) extraction, yt-dlp records the final
+            # post-processed path in 'requested_downloads'.
+            final_filepath = (
+                info.get('requested_downloads', [{}])[0].get('filepath')
+                or info.get('filepath')
+            )
+            if not final_filepath:
+                raise Exception("Could not reliably determine the final downloaded file path.")
+
+            return final_filepath
+        finally:
+            _release_ydl(ydl)
+
+    # Run the blocking yt-dlp operation on the dedicated executor, with the
+    # semaphore capping how many downloads are in flight at once.
+    async with DOWNLOAD_SEMAPHORE:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_DOWNLOAD_EXECUTOR, blocking_download)
+
+# Coalesce concurrent requests for the same URL: the first caller runs the
+# pipeline and later callers await its result. Besides saving duplicate
+# CPU/network work, this prevents two yt-dlp runs racing to write the same
+# output path.
+_INFLIGHT = {}
+_INFLIGHT_LOCK = asyncio.Lock()
+
+async def run_deduplicated_download(key, url):
+    """Runs the download for a URL, sharing one run among concurrent callers."""
+    async with _INFLIGHT_LOCK:
+        fut = _INFLIGHT.get(key)
+        owner = fut is None
+        if owner:
+            fut = asyncio.get_running_loop().create_future()
+            _INFLIGHT[key] = fut
+
+    if owner:
+        try:
+            fut.set_result(await run_yt_dlp_operation(url))
+        except Exception as e:
+            fut.set_exception(e)
+        finally:
+            _INFLIGHT.pop(key, None)
+
+    return await fut
 
 
 @app.get("/health", summary="Health Check")
@@ -120,13 +203,17 @@ async def download_mp3(url: str):
     if not url:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="URL parameter is required.")
 
-    output_template = os.path.join(DOWNLOAD_DIR, '%(title)s-%(id)s.%(ext)s')
-    
-    # Get cookie string from environment variable
-    cookie_string = os.getenv('YTDLP_COOKIES')
+    # Serve repeat requests straight from the cache without re-downloading.
+    cache_key = _cache_key('mp3', url)
+    cached_filepath = await get_cached_filepath(cache_key)
+    if cached_filepath:
+        return {
+            "message": "Download and conversion successful",
+            "download_url": f"/downloads/{os.path.basename(cached_filepath)}",
+        }
 
     try:
-        mp3_filepath = await run_yt_dlp_operation(url, output_template, cookie_string)
+        mp3_filepath = await run_deduplicated_download(cache_key, url)
 
         # yt-dlp appends .mp3 if conversion is successful, so ensure we have the correct extension
         if not mp3_filepath.endswith('.mp3'):
@@ -134,13 +221,15 @@ async def download_mp3(url: str):
             # It tries to find the .mp3 file based on the original name.
             base_name = os.path.splitext(mp3_filepath)[0]
             potential_mp3_path = f"{base_name}.mp3"
-            if os.path.exists(potential_mp3_path):
+            if await anyio.Path(potential_mp3_path).exists():
                 mp3_filepath = potential_mp3_path
             else:
                 # If still can't find, raise an error or try another strategy.
                 raise Exception(f"MP3 file not found after conversion for {url}. Expected: {potential_mp3_path}")
 
 
+        await cache_filepath(cache_key, mp3_filepath)
+
         mp3_filename = os.path.basename(mp3_filepath)
         download_url = f"/downloads/{mp3_filename}"
 
@@ -165,15 +254,23 @@ async def download_video(url: str):
     if not url:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="URL parameter is required.")
 
-    output_template = os.path.join(DOWNLOAD_DIR, '%(title)s-%(id)s.%(ext)s')
-    cookie_string = os.getenv('YTDLP_COOKIES') # Get cookie string for video downloads too
+    # Serve repeat requests straight from the cache without re-downloading.
+    cache_key = _cache_key('video', url)
+    cached_filepath = await get_cached_filepath(cache_key)
+    if cached_filepath:
+        return {
+            "message": "Download successful",
+            "download_url": f"/downloads/{os.path.basename(cached_filepath)}",
+        }
 
     try:
-        video_filepath = await run_yt_dlp_operation(url, output_template, cookie_string)
+        video_filepath = await run_deduplicated_download(cache_key, url)
 
         if not video_filepath:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Downloaded video file path could not be determined.")
 
+        await cache_filepath(cache_key, video_filepath)
+
         video_filename = os.path.basename(video_filepath)
         download_url = f"/downloads/{video_filename}"
         return {"message": "Download successful", "download_url": download_url}
@@ -183,23 +280,23 @@ async def download_video(url: str):
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred: {e}")
 
-@app.get('/downloads/{filename}')
-async def serve_downloaded_file(filename: str):
-    """
-    Serves downloaded files from the DOWNLOAD_DIR.
-    """
-    file_path = os.path.join(DOWNLOAD_DIR, filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found.")
-    
-    # Ensure the path is within the DOWNLOAD_DIR for security
-    # (send_from_directory does this automatically in Flask, but for FastAPI
-    #  it's good to be explicit or use FileResponse directly with abspath and checks)
-    return FileResponse(path=file_path, filename=filename)
+# Downloaded files are served by the StaticFiles mount above, which streams
+# from disk and handles range/conditional requests for resumable downloads.
 
 
 # This ensures the app runs when the script is executed directly for local development.
 # Render will use the 'uvicorn' command specified in the Dockerfile.
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop + httptools are the recommended production loop/parser and give
+    # noticeably better throughput than the default asyncio selector loop.
+    # One worker per core lets concurrent downloads (yt-dlp extraction and
+    # FFmpeg post-processing are CPU-heavy) scale past the GIL.
+    uvicorn.run(
+        "api:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=os.cpu_count(),
+        loop="uvloop",
+        http="httptools",
+    )
 